@@ -10,6 +10,60 @@ export const config = {
   },
 };
 
+const MAX_FILE_SIZE = 10 * 1024 * 1024; // 10MB
+
+// ISO-8601 (client default) or YYYY-MM-DD-HHMMSS (Python generators); the
+// filename is built from it, so nothing else may get through
+const TIMESTAMP_RE = /^\d{4}-\d{2}-\d{2}(-\d{6}|T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?)$/;
+
+class PayloadTooLargeError extends Error {}
+
+// Read a raw request body into memory, rejecting anything over maxSize
+async function readRawBody(req: NextApiRequest, maxSize: number): Promise<Buffer> {
+  const chunks: Buffer[] = [];
+  let size = 0;
+  for await (const chunk of req) {
+    size += chunk.length;
+    if (size > maxSize) {
+      throw new PayloadTooLargeError('File too large');
+    }
+    chunks.push(chunk);
+  }
+  return Buffer.concat(chunks);
+}
+
+// Save image and story to db/ and return the post data
+async function savePost(imageBuffer: Buffer, filename: string, story: Buffer | string, timestamp: string, type: string) {
+  // Ensure db directory exists
+  const dbDir = path.join(process.cwd(), 'db');
+  await mkdir(dbDir, { recursive: true });
+
+  // Save image
+  const imagePath = path.join(dbDir, filename);
+  await writeFile(imagePath, imageBuffer);
+
+  // Save story
+  if (story.length > 0) {
+    const storyPath = path.join(dbDir, filename.replace(/\.png$/, '_story.txt'));
+    await writeFile(storyPath, story);
+  }
+
+  const postData = {
+    id: filename,
+    timestamp,
+    story: story.toString(),
+    filename,
+    type,
+    likes: 0,
+    comments: 0,
+    shares: 0,
+  };
+
+  console.log(`📤 New ${type} post uploaded: ${filename}`);
+
+  return postData;
+}
+
 export default async function handler(
   req: NextApiRequest,
   res: NextApiResponse
@@ -19,78 +73,74 @@ export default async function handler(
   }
 
   try {
+    // Raw PNG body with metadata in headers, sent by the Python generators
+    if (req.headers['content-type']?.startsWith('image/png')) {
+      const imageBuffer = await readRawBody(req, MAX_FILE_SIZE);
+      if (imageBuffer.length === 0) {
+        return res.status(400).json({ error: 'No image file provided' });
+      }
+
+      const timestamp = (req.headers['x-timestamp'] as string) || new Date().toISOString();
+      if (!TIMESTAMP_RE.test(timestamp)) {
+        return res.status(400).json({ error: 'Invalid timestamp' });
+      }
+      const type = (req.headers['x-type'] as string) || 'generated';
+      const storyB64 = (req.headers['x-story-b64'] as string) || '';
+      const story = Buffer.from(storyB64, 'base64');
+
+      const filename = `${timestamp.replace(/[:.]/g, '-')}.png`;
+      return res.status(200).json(await savePost(imageBuffer, filename, story, timestamp, type));
+    }
+
     const form = formidable({
-      maxFileSize: 10 * 1024 * 1024, // 10MB
+      maxFileSize: MAX_FILE_SIZE,
       keepExtensions: true,
     });
 
     const [fields, files] = await form.parse(req);
-    
+
     const file = Array.isArray(files.image) ? files.image[0] : files.image;
-    
+
     if (!file) {
       return res.status(400).json({ error: 'No image file provided' });
     }
-    
+
     // Get metadata
     const timestamp = (Array.isArray(fields.timestamp) ? fields.timestamp[0] : fields.timestamp) as string || new Date().toISOString();
+    if (!TIMESTAMP_RE.test(timestamp)) {
+      return res.status(400).json({ error: 'Invalid timestamp' });
+    }
     const type = (Array.isArray(fields.type) ? fields.type[0] : fields.type) as string || 'generated';
-    
+
     // Generate filename with timestamp
     const timestampStr = timestamp.replace(/[:.]/g, '-');
-    const originalName = file.originalFilename || 'image.png';
-    
+    const originalName = path.basename(file.originalFilename || 'image.png');
+
     // If originalName is just an extension like ".png", use just timestamp + extension
-    const filename = originalName.startsWith('.') 
-      ? `${timestampStr}${originalName}` 
+    const filename = originalName.startsWith('.')
+      ? `${timestampStr}${originalName}`
       : `${timestampStr}-${originalName}`;
-    
-    // Ensure db directory exists
-    const dbDir = path.join(process.cwd(), 'db');
-    await mkdir(dbDir, { recursive: true });
-    
-    // Save image
+
     const imageBuffer = await fs.promises.readFile(file.filepath);
-    const imagePath = path.join(dbDir, filename);
-    await writeFile(imagePath, imageBuffer);
-    
+
     // Handle story - can be either a file or text field
-    let story = '';
+    let story: Buffer | string = '';
     const storyFile = Array.isArray(files.story) ? files.story[0] : files.story;
-    
+
     if (storyFile) {
       // Story provided as a file
-      const storyBuffer = await fs.promises.readFile(storyFile.filepath);
-      const storyPath = path.join(dbDir, filename.replace(/\.png$/, '_story.txt'));
-      await writeFile(storyPath, storyBuffer);
-      story = storyBuffer.toString('utf8');
+      story = await fs.promises.readFile(storyFile.filepath);
     } else {
       // Fallback to text field for backward compatibility
-      const storyText = (Array.isArray(fields.story) ? fields.story[0] : fields.story) as string || '';
-      if (storyText) {
-        const storyPath = path.join(dbDir, filename.replace(/\.png$/, '_story.txt'));
-        await writeFile(storyPath, storyText, 'utf8');
-        story = storyText;
-      }
+      story = (Array.isArray(fields.story) ? fields.story[0] : fields.story) as string || '';
     }
-    
-    const postData = {
-      id: filename,
-      timestamp,
-      story: story || '',
-      filename,
-      type,
-      likes: 0,
-      comments: 0,
-      shares: 0,
-    };
-    
-    console.log(`📤 New ${type} post uploaded: ${filename}`);
-    
-    return res.status(200).json(postData);
+
+    return res.status(200).json(await savePost(imageBuffer, filename, story, timestamp, type));
   } catch (error) {
+    if (error instanceof PayloadTooLargeError || (error as { httpCode?: number }).httpCode === 413) {
+      return res.status(413).json({ error: 'File too large' });
+    }
     console.error('Upload error:', error);
     return res.status(500).json({ error: 'Failed to upload file' });
   }
 }
-
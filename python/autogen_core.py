@@ -0,0 +1,473 @@
+# Shared core for autogen.py and gen.py
+# Configuration, SwarmUI client, image handling and art server upload
+
+import openai
+import httpx
+import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from pybase64 import b64decode, b64encode
+import hashlib
+import os
+import time
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from pathlib import Path
+from types import MappingProxyType
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows has no flock, runs without the db/ lock
+    fcntl = None
+
+
+# Configuration from environment variables, parsed once per process
+@dataclass(frozen=True)
+class Config():
+    """Settings read from the environment / .env file"""
+    server_url: str
+    openai_api_key: str
+    swarm_url: str
+    swarm_output_dir: str
+    debug: bool
+    llm_cache: bool
+    openai_rpm: int
+    openai_tpm: int
+    stall_seconds: int
+    interval_minutes: int
+    keepalive_seconds: int
+    batch_size: int
+
+
+@lru_cache(maxsize=1)
+def cfg() -> Config:
+    """Load .env once and return the parsed configuration"""
+    load_dotenv()
+    config = Config(
+        server_url=os.getenv("SERVER_URL", "http://localhost:3000"),
+        openai_api_key=os.getenv("OPENAI_API_KEY", "your-openai-api-key-here"),
+        swarm_url=os.getenv("SWARMUI_URL", "http://127.0.0.1:7801"),
+        swarm_output_dir=os.getenv("SWARMUI_OUTPUT_DIR", ""),
+        debug=os.getenv("DEBUG", "false").lower() == "true",
+        llm_cache=os.getenv("LLM_CACHE", "false").lower() == "true",
+        openai_rpm=int(os.getenv("OPENAI_RPM", "500")),
+        openai_tpm=int(os.getenv("OPENAI_TPM", "200000")),
+        stall_seconds=int(os.getenv("SWARMUI_STALL_SECONDS", "15")),
+        interval_minutes=int(os.getenv("AUTOGEN_INTERVAL_MINUTES", "1440")),
+        keepalive_seconds=int(os.getenv("AUTOGEN_KEEPALIVE_SECONDS", "0")),
+        batch_size=int(os.getenv("AUTOGEN_BATCH", "1"))
+    )
+    if config.openai_rpm <= 0 or config.openai_tpm <= 0:
+        raise ValueError("OPENAI_RPM and OPENAI_TPM must be greater than 0")
+    return config
+
+
+# Set up the OpenAI API client on a long-lived HTTP/2 connection pool, so
+# calls in a run share one multiplexed connection
+OPENAI_HTTP = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=4, max_connections=8, keepalive_expiry=3600),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+client = openai.OpenAI(api_key=cfg().openai_api_key, http_client=OPENAI_HTTP)
+
+
+class RateLimiter():
+    """Leaky-bucket throttle on OpenAI requests and tokens per minute
+
+    Capacity refills continuously at rpm/60 and tpm/60 per second, so callers
+    wait just long enough up front instead of hitting 429s and backing off.
+    It covers the live chat calls in autogen.py and gen.py (via complete()).
+    Batch API jobs have their own queue limits, and postedit.py runs in its
+    own process bounded by POSTEDIT_CONCURRENCY instead.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = rpm
+        self.available_tokens = tpm
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, est_tokens):
+        """Block until one request of about est_tokens fits in the limits, then reserve it"""
+        est_tokens = min(est_tokens, self.tpm)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.last_update
+                self.last_update = now
+                self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+                self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+
+                if self.available_requests >= 1 and self.available_tokens >= est_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= est_tokens
+                    return
+
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.rpm,
+                    (est_tokens - self.available_tokens) * 60 / self.tpm
+                )
+            time.sleep(wait)
+
+
+throttle = RateLimiter(cfg().openai_rpm, cfg().openai_tpm)
+
+
+def trim_to_boundary(text):
+    """Cut a truncated completion back to its last full sentence, else its last full clause or word"""
+    for marks in ".!?", ",;":
+        end = max(text.rfind(mark) for mark in marks)
+        # Don't throw away most of the text for an early boundary
+        if end >= len(text) // 2:
+            return text[:end + 1].rstrip(",;")
+    return text.rsplit(None, 1)[0] if " " in text.strip() else text
+
+
+# Tokens reserved per image part, about what an 896x1152 render costs at high detail
+IMAGE_TOKEN_ESTIMATE = 800
+
+
+def estimate_tokens(messages):
+    """Rough prompt size: ~4 characters per text token plus a fixed allowance per image
+
+    Image parts are data URLs; counting their base64 as text would
+    overestimate by hundreds of thousands of tokens.
+    """
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or ():
+            if part.get("type") == "text":
+                chars += len(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                images += 1
+    return chars // 4 + images * IMAGE_TOKEN_ESTIMATE
+
+
+def complete(model, messages, max_words=None, **kwargs):
+    """Return the completion text; a streamed call is cut off at max_words and trimmed to a clean boundary"""
+    max_output = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or 500
+    throttle.acquire(est_tokens=estimate_tokens(messages) + max_output)
+    if not kwargs.get("stream"):
+        response = client.chat.completions.create(model=model, messages=messages, **kwargs)
+        return response.choices[0].message.content
+
+    text = ""
+    stream = client.chat.completions.create(model=model, messages=messages, **kwargs)
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content or ""
+            text += piece
+            # Only a chunk with whitespace can finish a word; the next piece
+            # might still continue it, so count strictly more than max_words
+            if max_words and not piece.isalnum() and len(text.split()) > max_words:
+                text = trim_to_boundary(text)
+                if cfg().debug:
+                    print(f"✂️ Stopped stream at {max_words} words, kept {len(text.split())}")
+                break
+    finally:
+        stream.close()
+    return text
+
+
+def cached_chat(model, messages, **kwargs):
+    """Return the completion text, served from db/.llm_cache on an exact repeat when LLM_CACHE is on"""
+    if not cfg().llm_cache:
+        return complete(model, messages, **kwargs)
+
+    key = hashlib.sha256(orjson.dumps({"m": model, "msgs": messages, "kw": kwargs}, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    path = Path("db/.llm_cache", f"{key}.txt")
+    if path.is_file():
+        if cfg().debug:
+            print(f"🗃️ LLM cache hit: {key[:12]}")
+        return path.read_text(encoding="utf-8")
+
+    content = complete(model, messages, **kwargs)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content, encoding="utf-8")
+    return content
+
+
+# Keep-alive HTTP session (SwarmUI and art server) and SwarmUI session ID,
+# reused across runs
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({"Connection": "keep-alive"})
+
+# Pooled connections with retries on connection errors and transient
+# statuses. Retry keeps its default idempotent methods, so a generation or
+# upload POST is never replayed after the server has accepted it.
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+)
+HTTP_SESSION.mount("http://", _adapter)
+HTTP_SESSION.mount("https://", _adapter)
+_session_id = None
+_session_lock = threading.Lock()
+
+# Generation POSTs run here while the caller polls SwarmUI's status
+_generate_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="swarmui")
+STATUS_POLL_SECONDS = 2
+
+# LoRA tags appended to every generated prompt
+LORA_TAGS = "<lora:chroma/sangww_000003750> <lora:chroma/Hyper-Chroma-low-step-LoRA:0.4>"
+
+
+def format_prompt(prompt):
+    """Close the generated prompt with a period and append photography specs and LoRA tags"""
+    prompt = prompt.strip()
+    if not prompt.endswith('.'):
+        prompt = prompt + '.'
+
+    photography_specs = ""
+    return prompt + "\n" + photography_specs + " " + LORA_TAGS
+
+
+def post_json(url, body, timeout):
+    """POST a JSON body (dict or pre-serialized bytes) to SwarmUI and return the decoded response"""
+    data = body if isinstance(body, bytes) else orjson.dumps(body)
+    r = HTTP_SESSION.post(url, data=data, headers={"Content-Type": "application/json"}, timeout=timeout)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+def ensure_session(refresh=False):
+    """Return the cached SwarmUI session ID, fetching a new one if needed"""
+    global _session_id
+    with _session_lock:
+        if _session_id and not refresh:
+            return _session_id
+        _session_id = None
+        try:
+            # Use POST request (as confirmed by debug script)
+            data = post_json(f"{cfg().swarm_url}/API/GetNewSession", {}, timeout=10)
+            _session_id = data["session_id"]
+            print(f"✅ Got session ID: {_session_id}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error getting SwarmUI session: {e}")
+        return _session_id
+
+
+def keep_warm():
+    """Ping SwarmUI and the art server so pooled connections stay open
+
+    OpenAI is left out: prewarm_openai() opens that connection before use,
+    and an unauthenticated HEAD there only ever returns 401.
+    """
+    for url in (cfg().swarm_url, cfg().server_url):
+        try:
+            HTTP_SESSION.head(url, timeout=5)
+        except requests.exceptions.RequestException as e:
+            if cfg().debug:
+                print(f"⚠️ Keep-alive ping to {url} failed: {e}")
+
+
+def warm_openai():
+    """Open the TLS + HTTP/2 connection to OpenAI through the client's own pool"""
+    try:
+        OPENAI_HTTP.head(f"{client.base_url}models", timeout=5)
+    except httpx.HTTPError as e:
+        if cfg().debug:
+            print(f"⚠️ Keep-alive ping to OpenAI failed: {e}")
+
+
+def prewarm_openai():
+    """Warm the OpenAI connection in the background while the caller gets ready"""
+    threading.Thread(target=warm_openai, name="openai-prewarm", daemon=True).start()
+
+
+# SwarmUI API configuration for Chroma model, built once at import.
+# Each request only adds its prompt and the current session ID; read-only
+# so no request can change it for the others.
+BODY_TEMPLATE = MappingProxyType({
+    "images": 1,
+    "session_id": "",  # Will be set by ensure_session()
+    "donotsave": False,  # Return a file path instead of inline base64
+    "negativeprompt": "lowres, blurry, cgi",
+    "model": "chroma/chroma-unlocked-v48-detail-calibrated.safetensors",  # Your Chroma model
+    "width": 896,
+    "height": 1152,
+    "cfgscale": 3.3,
+    "steps": 15,
+    "seed": -1,
+    "sampler": "er_sde",  # ER-SDE-Solver sampler
+    "scheduler": "beta",  # Beta scheduler
+    "samplersigmamax": 9.7,  # Sampler Sigma Max
+    "clipstopatlayer": -2,  # CLIP Stop At Layer
+    "automaticvae": True  # Automatic VAE
+})
+
+
+class SwarmUIRequest():
+    URL = f"{cfg().swarm_url}/API/GenerateText2Image"
+
+    def __init__(self, prompt, **params):
+        # params override template fields, e.g. negativeprompt
+        self.body = {**BODY_TEMPLATE, **params, "prompt": prompt}
+        self._payload = None
+        self._payload_session = None
+
+    def payload(self):
+        """Return the serialized body, re-encoded only when the session ID changes"""
+        if self._payload is None or self._payload_session != self.body["session_id"]:
+            self._payload = orjson.dumps(self.body)
+            self._payload_session = self.body["session_id"]
+        return self._payload
+
+    def generate(self):
+        """POST the generation while polling SwarmUI's status; return None if the backend stalls"""
+        future = _generate_pool.submit(post_json, self.URL, self.payload(), 120)
+        last_busy = time.monotonic()
+        while True:
+            try:
+                return future.result(timeout=STATUS_POLL_SECONDS)
+            except FutureTimeout:
+                pass
+
+            try:
+                status = post_json(f"{cfg().swarm_url}/API/GetCurrentStatus", {"session_id": self.body["session_id"]}, timeout=5)
+            except (requests.exceptions.RequestException, ValueError):
+                continue  # No status available, fall back to the POST timeout
+
+            queue = status.get("status", {})
+            backend = status.get("backend_status", {}).get("status")
+            if any(queue.get(k) for k in ("live_gens", "waiting_gens", "loading_models", "waiting_backends")):
+                last_busy = time.monotonic()
+            if backend == "errored" or time.monotonic() - last_busy > cfg().stall_seconds:
+                print(f"⚠️ SwarmUI stalled (backend: {backend}), interrupting...")
+                try:
+                    post_json(f"{cfg().swarm_url}/API/InterruptAll", {"session_id": self.body["session_id"], "other_sessions": False}, timeout=5)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    print(f"Error interrupting SwarmUI: {e}")
+                return None
+
+    def sendRequest(self):
+        """Send the request to SwarmUI and return the result"""
+        try:
+            # Reuse the session from previous runs if we have one
+            self.body["session_id"] = ensure_session()
+            if not self.body["session_id"]:
+                return None
+
+            result = self.generate()
+
+            # Retry once with a fresh session on a stall or session error
+            if result is None or result.get("error_id") == "invalid_session_id":
+                if result is None:
+                    print("Retrying with a new session...")
+                else:
+                    print("Session invalid, getting new session...")
+                self.body["session_id"] = ensure_session(refresh=True)
+                if not self.body["session_id"]:
+                    return None
+                result = self.generate()
+                if result is None:
+                    print("SwarmUI stalled again, giving up")
+                    return None
+
+            # Check for other errors
+            if "error" in result:
+                print(f"SwarmUI API error: {result['error']}")
+                return None
+
+            return result
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error making request to SwarmUI: {e}")
+            return None
+
+
+def fetch_image(img):
+    """Return the PNG bytes for a SwarmUI image result (saved-file path or base64 data URL)"""
+    if img.startswith('data:'):
+        # Inline base64, returned when SwarmUI is configured not to save.
+        # Pad and decode in one buffer instead of copying the string around.
+        buf = bytearray(img, 'ascii')
+        start = buf.index(b',') + 1
+        buf += b'=' * (-(len(buf) - start) & 3)
+        return b64decode(memoryview(buf)[start:], validate=False)
+
+    # Read the saved file straight from SwarmUI's output folder when it
+    # shares this machine ("View/" in the returned path is that folder)
+    if cfg().swarm_output_dir:
+        local = Path(cfg().swarm_output_dir, img.lstrip('/').removeprefix('View/'))
+        if local.is_file():
+            return local.read_bytes()
+
+    # Fetch the saved file from SwarmUI without a base64 round trip
+    r = HTTP_SESSION.get(f"{cfg().swarm_url}/{img.lstrip('/')}", timeout=60)
+    r.raise_for_status()
+    return r.content
+
+
+def upload_to_server(image_data, story, timestamp, post_type):
+    """Upload image and story to the Next.js API"""
+    try:
+        # Raw PNG body with metadata in headers, no multipart encoding;
+        # the server names the file from the timestamp
+        headers = {
+            "Content-Type": "image/png",
+            "X-Timestamp": timestamp,
+            "X-Type": post_type,
+            "X-Story-B64": b64encode(story.encode("utf-8")).decode("ascii")
+        }
+
+        response = HTTP_SESSION.post(f"{cfg().server_url}/api/upload", data=image_data, headers=headers, timeout=30)
+        response.raise_for_status()
+
+        result = orjson.loads(response.content)
+        print(f"✅ Upload successful: {result.get('id', 'unknown')}")
+        return True
+
+    except requests.exceptions.RequestException as e:
+        print(f"⚠️ Upload failed: {e}")
+        return False
+    except Exception as e:
+        print(f"⚠️ Upload error: {e}")
+        return False
+
+
+def write_atomic(path, data):
+    """Write bytes to a temp file and rename it into place, so readers never see a partial file"""
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+        # Images are uploaded from memory and never read back here, so drop
+        # them from the page cache instead of evicting hotter pages
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def db_lock():
+    """Hold an exclusive lock on db/ so concurrent generators don't collide on timestamps"""
+    os.makedirs("db", exist_ok=True)
+    with open("db/.lock", "w") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,25 +1,30 @@
 # Single Image Generation Test
 # Tests SwarmUI integration without server dependency
 
+import re
+import os
+import sys
+import time
+import threading
+import atexit
+import orjson
 import openai
 import requests
-import re
-from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from pybase64 import b64encode
 from time import gmtime, strftime
-import os
-from dotenv import load_dotenv
+from pathlib import Path
+from autogen_core import (
+    cfg, client, cached_chat, prewarm_openai, format_prompt, ensure_session, SwarmUIRequest, fetch_image, upload_to_server, write_atomic, db_lock
+)
 
-# Load environment variables from .env file
-load_dotenv()
+# Start the OpenAI handshake now so the first prompt call finds it ready.
+# The prompt and story calls then share the same pooled connection.
+prewarm_openai()
 
-# Configuration from environment variables
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key-here")
-SWARMUI_URL = os.getenv("SWARMUI_URL", "http://127.0.0.1:7801")
-SERVER_URL = os.getenv("SERVER_URL", "http://localhost:3000")
-DEBUG = os.getenv("DEBUG", "false").lower() == "true"
-
-# Set up the OpenAI API client
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# Disk writes run here so the story call doesn't wait on them
+IO_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="io")
+atexit.register(IO_POOL.shutdown, wait=True)
 
 # Define your prompt - Enhanced for Chroma style and better imagination
 instruction = """Create a 100-word Chroma prompt for image generation.
@@ -52,109 +57,126 @@ Exclude topics around: terrarium, hologram, bio-luminescent, bird, fish, brass,
 Only include the prompt in your response. The person is Korean man but this has nothing to do with the story, just start the prompt with 'Korean man'. but don't emphasize any other Korean elements in the prompt.
 """
 
+# The instruction asks for ~100 words; stop streaming a prompt that runs
+# far past that rather than wait for the rest
+PROMPT_MAX_WORDS = 160
 
-class SwarmUIRequest():
-    def __init__(self, prompt):
-        # SwarmUI API configuration for Chroma model
-        self.url = f"{SWARMUI_URL}/API/GenerateText2Image"
-        self.body = {
-            "images": 1,
-            "session_id": "",  # Will be set by getSession()
-            "donotsave": True,
-            "prompt": prompt,
-            "negativeprompt": "lowres, blurry, cgi, china",
-            "model": "chroma/chroma-unlocked-v48-detail-calibrated.safetensors",  # Your Chroma model
-            "width": 896,
-            "height": 1152,
-            "cfgscale": 3.3,
-            "steps": 15,
-            "seed": -1,
-            "sampler": "er_sde",  # ER-SDE-Solver sampler
-            "scheduler": "beta",  # Beta scheduler
-            "samplersigmamax": 9.7,  # Sampler Sigma Max
-            "clipstopatlayer": -2,  # CLIP Stop At Layer
-            "automaticvae": True  # Automatic VAE
-        }
-        self.session_id = None
+# Output limits. gpt-5-mini is a reasoning model without temperature/top_p
+# or max_tokens, so the prompt call trims reasoning instead and caps all
+# completion tokens (reasoning included) at ~100 words plus slack.
+prompt_params = {"reasoning_effort": "minimal", "max_completion_tokens": 300}
+story_params = {"max_tokens": 80, "temperature": 0.8}
 
-    def getSession(self):
-        """Get a new session ID from SwarmUI"""
-        try:
-            # Use POST request (as confirmed by debug script)
-            response = requests.post(f"{SWARMUI_URL}/API/GetNewSession", json={}, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            self.session_id = data["session_id"]
-            self.body["session_id"] = self.session_id
-            print(f"✅ Got session ID: {self.session_id}")
-            return True
-        except requests.exceptions.RequestException as e:
-            print(f"Error getting SwarmUI session: {e}")
-            return False
+# How often to check on a Batch API job (they can take up to 24h)
+BATCH_POLL_SECONDS = 30
+
+# Instruction for the story written from the rendered image
+story_system_prompt = """You help create a short instagram story. Use the original prompt just for information, but totally rewrite it. The original prompt may not be related to the image. Focus on the image, and create a new post from the image as a first person account, in a fictional world. Make it short, less than 35 words.
+    
+    Do not include 3rd person descriptors--like you won't call your reality 'retro-futuristic' even if the prompt has it. Don't say awkward things like "brass watch" like even in fictional world they won't describe it that way. Perhaps, just give technological terms instead. Don't use terms like "cradling," "hum," "orb," "terrarium," or other poetic sounding phrases. Keep it real and average person.
+    
+    Return only the new story content. You can opt to include 1 or 2 hashtags at the end, or also none. """
+
+# Static messages lead every call, byte-identical between runs, so OpenAI's
+# prompt cache can match the prefix; per-run content goes last
+prompt_messages = [
+    {"role": "system", "content": "Your role is to help generates image generation prompts. You have a great sense of design fiction, focused on provocative but strangely everyday elements."},
+    {"role": "system", "content": instruction}
+]
+story_messages = [
+    {"role": "system", "content": story_system_prompt}
+]
 
-    def sendRequest(self):
-        """Send the request to SwarmUI and return the result"""
+
+def story_user_message(prompt, image_data):
+    """Build the per-run story message carrying the prompt text and the rendered image"""
+    # Encode the image already in memory for the vision API
+    image_data_b64 = b64encode(image_data).decode('ascii')
+    user_text = f"Image prompt used (to be discarded): {prompt}"
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": user_text
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/png;base64,{image_data_b64}"
+                }
+            }
+        ]
+    }
+
+
+def clean_story(story):
+    """Strip markdown formatting from a generated story"""
+    story = story.strip()
+    story = re.sub(r'```[a-z]*\n?', '', story)
+    story = re.sub(r'\*\*([^*]+)\*\*', r'\1', story)
+    story = re.sub(r'\*([^*]+)\*', r'\1', story)
+    return story.strip()
+
+
+def render_image(prompt):
+    """Render the prompt with SwarmUI and save it to db/; return (timestamp, image bytes, image write future) or None"""
+    # One generator at a time writes to db/, so timestamps can't collide
+    with db_lock():
+        # Format timestamp, unique in db/ even for back-to-back batch renders
+        t = strftime("%Y-%m-%d-%H%M%S", gmtime())
+        while os.path.exists(f"db/{t}.txt"):
+            time.sleep(1)
+            t = strftime("%Y-%m-%d-%H%M%S", gmtime())
+
+        # Generate image using SwarmUI
+        print("🖼️ Generating image with SwarmUI...")
+        js = SwarmUIRequest(prompt, negativeprompt="lowres, blurry, cgi, china").sendRequest()
+        
+        if js is None or not js.get("images"):
+            print("❌ Image generation failed")
+            return None
+        
+        # Fetch and save image
+        print("💾 Saving image...")
         try:
-            if not self.session_id:
-                if not self.getSession():
-                    return None
-            
-            r = requests.post(self.url, json=self.body, timeout=120)
-            r.raise_for_status()
-            result = r.json()
-            
-            # Handle session invalidation
-            if "error_id" in result and result["error_id"] == "invalid_session_id":
-                print("Session invalid, getting new session...")
-                if self.getSession():
-                    # Retry with new session
-                    r = requests.post(self.url, json=self.body, timeout=120)
-                    r.raise_for_status()
-                    result = r.json()
-                else:
-                    return None
-            
-            # Check for other errors
-            if "error" in result:
-                print(f"SwarmUI API error: {result['error']}")
-                return None
-                
-            return result
-        except requests.exceptions.RequestException as e:
-            print(f"Error making request to SwarmUI: {e}")
+            image_data = fetch_image(js["images"][0])
+            if cfg().debug:
+                print(f"✅ Successfully fetched {len(image_data)} bytes")
+        except Exception as fetch_error:
+            print(f"❌ Image fetch error: {fetch_error}")
             return None
-
-def upload_to_server(image_path, story_path, timestamp):
-    """Upload image and story file to Next.js API"""
-    try:
-        url = f"{SERVER_URL}/api/upload"
         
-        # Read both image and story files
-        with open(image_path, "rb") as img_file, open(story_path, "rb") as story_file:
-            # Use just ".png" extension so server only uses timestamp
-            files = {
-                "image": (".png", img_file, "image/png"),
-                "story": ("_story.txt", story_file, "text/plain")
-            }
-            data = {
-                "timestamp": timestamp,
-                "type": "autogen"
-            }
-            
-            # Make the upload request
-            response = requests.post(url, files=files, data=data, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            print(f"✅ Upload successful: {result.get('id', 'unknown')}")
-            return True
-            
-    except requests.exceptions.RequestException as e:
-        print(f"⚠️ Upload failed: {e}")
-        return False
-    except Exception as e:
-        print(f"⚠️ Upload error: {e}")
-        return False
+        # Save prompt locally; this also reserves the timestamp in db/
+        prompt_filename = f"db/{t}.txt"
+        Path(prompt_filename).write_text(prompt, encoding="utf-8", newline="")
+        print(f"✅ Prompt saved: {prompt_filename}")
+
+    # Save image locally in the background while the story is written
+    saved = IO_POOL.submit(write_atomic, f"db/{t}.png", image_data)
+    if cfg().debug:
+        print(f"📊 Image size: {len(image_data)} bytes")
+    return t, image_data, saved
+
+
+def publish(t, image_data, story, saved):
+    """Save the story next to the image and upload both to the Next.js server"""
+    saved.result()
+    print(f"✅ Image saved: db/{t}.png")
+
+    story_filename = f"db/{t}_story.txt"
+    Path(story_filename).write_text(story, encoding="utf-8", newline="")
+    print(f"✅ Story saved: {story_filename}")
+    
+    # Upload to Next.js API if available
+    print("📤 Uploading to Next.js server...")
+    upload_success = upload_to_server(image_data, story, t, "autogen")
+    
+    if upload_success:
+        print("✅ Successfully uploaded to Next.js server")
+    else:
+        print("⚠️ Failed to upload to Next.js server (this is optional)")
+
 
 def generate_single_image():
     """Generate a single test image"""
@@ -162,166 +184,158 @@ def generate_single_image():
     print("=" * 50)
     
     try:
+        # Open the SwarmUI session while OpenAI writes the prompt
+        session_thread = threading.Thread(target=ensure_session, name="swarmui-session", daemon=True)
+        session_thread.start()
+
         # Get SD prompt using OpenAI 4o-mini
         print("🤖 Generating prompt with OpenAI...")
-        response = client.chat.completions.create(
+        content = cached_chat(
             model="gpt-5-mini",
-            messages=[
-                {"role": "system", "content": "Your role is to help generates image generation prompts. You have a great sense of design fiction, focused on provocative but strangely everyday elements."},
-                {"role": "system", "content": instruction}
-            ],
+            messages=prompt_messages,
+            prompt_cache_key="latent-self-gen-prompt",
+            **prompt_params,
+            stream=True,
+            max_words=PROMPT_MAX_WORDS,
         )
 
-        # Format prompt
-        prompt = response.choices[0].message.content.strip()
-        if not prompt.endswith('.'):
-            prompt = prompt + '.'
-        
-        # Add LoRA tags and photography specs to the end of the prompt
-        lora_tags = "<lora:chroma/sangww_000003750> <lora:chroma/Hyper-Chroma-low-step-LoRA:0.4>"
-        photography_specs = ""
-        prompt = prompt + "\n" + photography_specs + " " + lora_tags
-        
+        # Format prompt, adding LoRA tags and photography specs
+        prompt = format_prompt(content)
         print(f"📝 Generated prompt: {prompt}")
+        session_thread.join()
 
-        # Format timestamp
-        t = strftime("%Y-%m-%d-%H%M%S", gmtime())
-
-        # Generate image using SwarmUI
-        print("🖼️ Generating image with SwarmUI...")
-        js = SwarmUIRequest(prompt).sendRequest()
-        
-        if js is None:
-            print("❌ Image generation failed")
-            return False
-        
-        # Decode and save image
-        print("💾 Saving image...")
-        try:
-            # Get the base64 string and clean it
-            base64_string = js["images"][0]
-            print(f"📊 Base64 length: {len(base64_string)}")
-            
-            # Remove any data URL prefix if present
-            if base64_string.startswith('data:image'):
-                base64_string = base64_string.split(',')[1]
-            
-            # Add padding if needed
-            missing_padding = len(base64_string) % 4
-            if missing_padding:
-                base64_string += '=' * (4 - missing_padding)
-            
-            image_data = b64decode(base64_string)
-            print(f"✅ Successfully decoded {len(image_data)} bytes")
-            
-        except Exception as decode_error:
-            print(f"❌ Base64 decode error: {decode_error}")
-            print(f"📊 Raw base64 (first 100 chars): {base64_string[:100]}...")
+        rendered = render_image(prompt)
+        if rendered is None:
             return False
-        
-        # Create local db directory if it doesn't exist
-        os.makedirs("db", exist_ok=True)
-        
-        # Save image locally
-        filename = f"db/{t}.png"
-        with open(filename, "wb") as f:
-            f.write(image_data)
-        
-        # Save prompt locally
-        prompt_filename = f"db/{t}.txt"
-        with open(prompt_filename, "w", encoding="utf-8") as f:
-            f.write(prompt)
+        t, image_data, saved = rendered
         
         # Generate Twitter-style story with image
-        story_filename = f"db/{t}_story.txt"
         print("📱 Generating story with image...")
         try:
-            # Read the saved image for vision API
-            with open(filename, 'rb') as img_file:
-                image_data_b64 = b64encode(img_file.read()).decode('utf-8')
-            
-            system_prompt = """You help create a short instagram story. Use the original prompt just for information, but totally rewrite it. The original prompt may not be related to the image. Focus on the image, and create a new post from the image as a first person account, in a fictional world. Make it short, less than 35 words.
-    
-    Do not include 3rd person descriptors--like you won't call your reality 'retro-futuristic' even if the prompt has it. Don't say awkward things like "brass watch" like even in fictional world they won't describe it that way. Perhaps, just give technological terms instead. Don't use terms like "cradling," "hum," "orb," "terrarium," or other poetic sounding phrases. Keep it real and average person.
-    
-    Return only the new story content. You can opt to include 1 or 2 hashtags at the end, or also none. """
-            
-            user_text = f"Image prompt used (to be discarded): {prompt}"
-            
-            story_response = client.chat.completions.create(
+            story = cached_chat(
                 model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": user_text
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{image_data_b64}"
-                                }
-                            }
-                        ]
-                    }
-                ],
+                messages=story_messages + [story_user_message(prompt, image_data)],
+                prompt_cache_key="latent-self-gen-story",
+                **story_params,
             )
-            
-            story = story_response.choices[0].message.content.strip()
-            
-            # Clean any markdown formatting
-            story = re.sub(r'```[a-z]*\n?', '', story)
-            story = re.sub(r'\*\*([^*]+)\*\*', r'\1', story)
-            story = re.sub(r'\*([^*]+)\*', r'\1', story)
-            story = story.strip()
-            
+            story = clean_story(story)
             print(f"📱 Generated story: {story}")
             
-            # Save story locally
-            with open(story_filename, "w", encoding="utf-8") as f:
-                f.write(story)
-            
-            print(f"✅ Story saved: {story_filename}")
-            
         except Exception as story_error:
             print(f"⚠️ Story generation failed: {story_error}")
-            if DEBUG:
+            if cfg().debug:
                 import traceback
                 traceback.print_exc()
             story = "Story generation failed"
-            # Save fallback story
-            with open(story_filename, "w", encoding="utf-8") as f:
-                f.write(story)
-        
-        print(f"✅ Image saved: {filename}")
-        print(f"✅ Prompt saved: {prompt_filename}")
-        print(f"📊 Image size: {len(image_data)} bytes")
-        
-        # Upload to Next.js API if available
-        print("📤 Uploading to Next.js server...")
-        upload_success = upload_to_server(filename, story_filename, t)
-        
-        if upload_success:
-            print("✅ Successfully uploaded to Next.js server")
-        else:
-            print("⚠️ Failed to upload to Next.js server (this is optional)")
         
+        publish(t, image_data, story, saved)
         return True
         
     except Exception as e:
         print(f"❌ Error: {e}")
-        if DEBUG:
+        if cfg().debug:
             import traceback
             traceback.print_exc()
         return False
 
+
+def run_openai_batch(bodies, label):
+    """Send chat completion bodies through OpenAI's Batch API and return their texts by custom_id
+
+    Errors are reported and give an empty (or partial) result, so callers
+    fall back the same way as for a failed request.
+    """
+    lines = b"\n".join(
+        orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+        for custom_id, body in bodies.items()
+    )
+    results = {}
+    batch_file = None
+    try:
+        batch_file = client.files.create(file=(f"{label}.jsonl", lines), purpose="batch")
+        batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        print(f"📦 Submitted {label} batch {batch.id} ({len(bodies)} requests)")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_SECONDS)
+            batch = client.batches.retrieve(batch.id)
+            if cfg().debug:
+                print(f"⏳ {label} batch: {batch.status}")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"❌ {label} batch ended as {batch.status}")
+            return results
+
+        for line in client.files.content(batch.output_file_id).content.splitlines():
+            row = orjson.loads(line)
+            response = row.get("response") or {}
+            content = None
+            if response.get("status_code") == 200:
+                content = response["body"]["choices"][0]["message"]["content"]
+            if content:
+                results[row["custom_id"]] = content
+            else:
+                print(f"⚠️ {row['custom_id']} failed in {label} batch")
+    except (openai.OpenAIError, requests.exceptions.RequestException) as e:
+        print(f"❌ {label} batch error: {e}")
+    finally:
+        # The request file is only needed until the batch has run
+        if batch_file is not None:
+            try:
+                client.files.delete(batch_file.id)
+            except openai.OpenAIError as e:
+                print(f"⚠️ Could not delete {label} batch file {batch_file.id}: {e}")
+    return results
+
+
+def generate_batch(n):
+    """Generate n images with both OpenAI steps sent as Batch API jobs (half price, slower)"""
+    print(f"🎨 Batch Generation of {n} images")
+    print("=" * 50)
+
+    # Every prompt request is identical; sampling makes each one different
+    prompt_body = {"model": "gpt-5-mini", "messages": prompt_messages, "prompt_cache_key": "latent-self-gen-prompt", **prompt_params}
+    prompts = run_openai_batch({f"image-{i}": prompt_body for i in range(n)}, "prompts")
+
+    rendered = {}
+    for custom_id, content in prompts.items():
+        prompt = format_prompt(content)
+        print(f"📝 Generated prompt: {prompt}")
+        result = render_image(prompt)
+        if result is not None:
+            rendered[custom_id] = (prompt, *result)
+
+    if not rendered:
+        return False
+
+    # Stories need the rendered images, so they go out as a second batch
+    story_bodies = {
+        custom_id: {
+            "model": "gpt-4o-mini",
+            "messages": story_messages + [story_user_message(prompt, image_data)],
+            "prompt_cache_key": "latent-self-gen-story",
+            **story_params
+        }
+        for custom_id, (prompt, t, image_data, saved) in rendered.items()
+    }
+    stories = run_openai_batch(story_bodies, "stories")
+
+    for custom_id, (prompt, t, image_data, saved) in rendered.items():
+        story = clean_story(stories[custom_id]) if custom_id in stories else "Story generation failed"
+        print(f"📱 Generated story: {story}")
+        publish(t, image_data, story, saved)
+    return True
+
+
 if __name__ == "__main__":
+    # --batch N sends N generations through the Batch API instead of one live run
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        if len(sys.argv) != 3 or not sys.argv[2].isdigit() or int(sys.argv[2]) < 1:
+            print("Usage: python gen.py --batch <N>   (N = number of images, at least 1)")
+            sys.exit(2)
+        success = generate_batch(int(sys.argv[2]))
+        sys.exit(0 if success else 1)
+
     print("🧪 SwarmUI Single Image Generation Test")
     print("Testing Chroma model with ER-SDE-Solver and Beta scheduler")
     print()
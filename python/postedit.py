@@ -8,10 +8,13 @@ and creates an audit file for review.
 """
 
 import openai
+import asyncio
 import os
 import sys
 import re
-import base64
+import hashlib
+import orjson
+from pathlib import Path
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -20,15 +23,49 @@ load_dotenv()
 # Configuration from environment variables
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key-here")
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+POSTEDIT_CONCURRENCY = int(os.getenv("POSTEDIT_CONCURRENCY", "8"))
+LLM_CACHE = os.getenv("LLM_CACHE", "false").lower() == "true"
+LLM_CACHE_DIR = Path("db/.llm_cache")
+BATCH_POLL_SECONDS = 30
 
 # Set up the OpenAI API client
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Patterns compiled once at import
+TIMESTAMP_RE = re.compile(r'(\d{4}-\d{2}-\d{2}-\d{6})')  # YYYY-MM-DD-HHMMSS
+HASHTAG_RE = re.compile(r'#\w+')
+
+# All markdown cleanup in one alternation, so the text is scanned once.
+# Each formatting branch captures the text to keep; code fences and
+# headers capture nothing and are dropped.
+MARKDOWN_RE = re.compile(
+    r'```[a-z]*\n?'                 # code blocks (```text or ```)
+    r'|\*\*\*([^*]+)\*\*\*'          # ***bold italic***
+    r'|\*\*([^*]+)\*\*'              # **bold**
+    r'|\*([^*]+)\*'                  # *italic*
+    r'|__([^_]+)__'                  # __bold__
+    r'|_([^_]+)_'                    # _italic_
+    r'|\[([^\]]+)\]\([^\)]+\)'       # links, keep text
+    r'|^#{1,6}\s+',                 # headers
+    re.MULTILINE
+)
+
+# Characters the inline markdown patterns above need to match. '#' is
+# left out because stories usually end in hashtags; headers are checked
+# separately at line starts.
+MARKDOWN_CHARS = frozenset('`*_[')
 
 
 def extract_timestamp_from_filename(filename):
     """Extract timestamp from filename like '2025-10-26-215555_story.txt'"""
-    # Match pattern: YYYY-MM-DD-HHMMSS
-    match = re.search(r'(\d{4}-\d{2}-\d{2}-\d{6})', filename)
+    # Generated files start with the timestamp; check that by slicing first
+    ts = filename[:17]
+    if (len(ts) == 17 and ts[4] == '-' and ts[7] == '-' and ts[10] == '-'
+            and ts[:4].isdigit() and ts[5:7].isdigit() and ts[8:10].isdigit() and ts[11:].isdigit()):
+        return ts
+    
+    # Match pattern: YYYY-MM-DD-HHMMSS anywhere in the name
+    match = TIMESTAMP_RE.search(filename)
     if match:
         return match.group(1)
     return None
@@ -36,29 +73,33 @@ def extract_timestamp_from_filename(filename):
 
 def extract_hashtags(text):
     """Extract hashtags from text"""
-    hashtags = re.findall(r'#\w+', text)
+    hashtags = HASHTAG_RE.findall(text)
     return hashtags
 
 
+def _markdown_repl(match):
+    """Keep the captured text of a markdown match, or drop it entirely
+
+    The kept text is cleaned again, so markers nested inside it (emphasis
+    in a link, italic in bold) are removed too.
+    """
+    for group in match.groups():
+        if group is not None:
+            return MARKDOWN_RE.sub(_markdown_repl, group)
+    return ''
+
+
 def clean_response_text(text):
     """Remove markdown formatting and code blocks, keep only plain text"""
     if not text:
         return ""
     
-    # Remove markdown code blocks (```text or ```)
-    text = re.sub(r'```[a-z]*\n?', '', text)
-    
-    # Remove markdown bold/italic formatting
-    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)  # **bold**
-    text = re.sub(r'\*([^*]+)\*', r'\1', text)      # *italic*
-    text = re.sub(r'__([^_]+)__', r'\1', text)      # __bold__
-    text = re.sub(r'_([^_]+)_', r'\1', text)        # _italic_
+    # Plain text (hashtags included) has nothing to substitute
+    if MARKDOWN_CHARS.isdisjoint(text) and not text.startswith('#') and '\n#' not in text:
+        return text.strip()
     
-    # Remove markdown links but keep text
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
-    
-    # Remove any remaining markdown headers
-    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
+    # Remove code blocks, bold/italic, links and headers in a single pass
+    text = MARKDOWN_RE.sub(_markdown_repl, text)
     
     # Strip whitespace and newlines
     text = text.strip()
@@ -76,9 +117,10 @@ def read_story_file(story_path):
         return None
 
 
-def find_image_file(story_path, timestamp):
+def find_image_file(story_path, timestamp, story_dir=None):
     """Find the corresponding image file"""
-    story_dir = os.path.dirname(story_path)
+    if story_dir is None:
+        story_dir = os.path.dirname(story_path)
     image_path = os.path.join(story_dir, f"{timestamp}.png")
     
     if os.path.exists(image_path):
@@ -98,62 +140,99 @@ def find_image_file(story_path, timestamp):
 
 
 
-def generate_improved_story(original_story, hashtags, image_path=None):
-    """Generate an improved version of the story using OpenAI"""
-    hashtags_text = ' '.join(hashtags) if hashtags else ''
-    
-    system_prompt = """You help create a short instagram story. Use the original just for information, totally rewrite it. The original may not be related to the image. Focus on the image, and create a new post from the image as a first person account, in a fictional world. Make it short, less than 35 words.
+story_system_prompt = """You help create a short instagram story. Use the original just for information, totally rewrite it. The original may not be related to the image. Focus on the image, and create a new post from the image as a first person account, in a fictional world. Make it short, less than 35 words.
     
     Don't say awkward things like "brass watch" like even in fictional world they won't describe it that way. Perhaps, just give technological terms instead. Don't use terms like "cradling," "hum," "orb," "terrarium," or other poetic sounding phrases. Keep it real and average person.
     
     Return only the new story content. Do not include any markdown formatting, code blocks, quotes, or other formatting. Just the raw text."""
 
-    # Build user prompt with image if available
-    user_content = []
+
+def story_request(original_story, hashtags, image_file_id=None):
+    """Build the Responses API request for an improved story, referencing an uploaded image if given"""
+    hashtags_text = ' '.join(hashtags) if hashtags else ''
     
     text_prompt = f"""Here is the original story (to be discarded): {original_story}
 
 {f'Keep these hashtags at the end: {hashtags_text}' if hashtags else 'You can opt to include 1 or 2 hashtags at the end, or also none.'}
 """
     
-    if image_path:
-        # Include image in the request
-        user_content.append({
-            "type": "text",
-            "text": text_prompt
-        })
-        # Add the image
-        with open(image_path, 'rb') as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-            user_content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/png;base64,{image_data}"
-                }
-            })
-    else:
-        user_content.append({
-            "type": "text",
-            "text": text_prompt
-        })
+    # Build user prompt with image if available
+    user_content = [{"type": "input_text", "text": text_prompt}]
+    if image_file_id:
+        user_content.append({"type": "input_image", "file_id": image_file_id, "detail": "auto"})
+    
+    return {
+        "model": "gpt-4o-mini" if image_file_id else "gpt-5-mini",
+        "instructions": story_system_prompt,
+        "input": [{"role": "user", "content": user_content}]
+    }
+
+
+def story_cache_path(original_story, hashtags, image_path=None):
+    """Cache file for a story, keyed by the request and the image's mtime and size"""
+    image = os.stat(image_path) if image_path else None
+    key = hashlib.blake2b(orjson.dumps({
+        "req": story_request(original_story, hashtags, "image" if image_path else None),
+        "img": [image.st_mtime_ns, image.st_size] if image else None,
+    }, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    return LLM_CACHE_DIR / f"postedit-{key}.txt"
+
+
+def read_cached_story(cache_path):
+    """Return the cached story, or None on a miss"""
+    if cache_path.is_file():
+        if DEBUG:
+            print(f"🗃️ LLM cache hit: {cache_path.name}")
+        return cache_path.read_text(encoding="utf-8")
+    return None
 
+
+def cache_story(cache_path, story):
+    """Store a generated story for reruns on unchanged inputs"""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_text(story, encoding="utf-8")
+
+
+async def _upload_image(image_path):
+    """Upload the PNG as a file instead of inlining it as base64 JSON"""
+    return await client.files.create(file=Path(image_path), purpose="vision")
+
+
+async def delete_uploads(file_ids):
+    """Delete uploaded files, reporting any that could not be removed"""
+    for file_id in file_ids:
+        try:
+            await client.files.delete(file_id)
+        except openai.OpenAIError as e:
+            print(f"⚠️ Could not delete uploaded file {file_id}: {e}")
+
+
+async def generate_improved_story(original_story, hashtags, image_path=None):
+    """Generate an improved version of the story using OpenAI"""
+    uploaded = None
+    cache_path = None
     try:
+        # With LLM_CACHE on, a rerun on the same story and image skips the API
+        if LLM_CACHE:
+            cache_path = await asyncio.to_thread(story_cache_path, original_story, hashtags, image_path)
+            cached = await asyncio.to_thread(read_cached_story, cache_path)
+            if cached:
+                print(f"✅ Reused cached story: {cached}")
+                return cached
+        
+        print("🤖 Generating improved story with OpenAI" + (" (including image analysis)" if image_path else "") + "...")
         if image_path:
-            print("🤖 Generating improved story with OpenAI (including image analysis)...")
-        else:
-            print("🤖 Generating improved story with OpenAI...")
+            uploaded = await _upload_image(image_path)
         
-        response = client.chat.completions.create(
-            model="gpt-4o-mini" if image_path else "gpt-5-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
-            ],
+        response = await client.responses.create(
+            **story_request(original_story, hashtags, uploaded.id if uploaded else None)
         )
         
-        raw_story = response.choices[0].message.content
+        raw_story = response.output_text
         improved_story = clean_response_text(raw_story)
         print(f"✅ Generated improved story: {improved_story}")
+        if cache_path and improved_story:
+            await asyncio.to_thread(cache_story, cache_path, improved_story)
         return improved_story
         
     except Exception as e:
@@ -162,6 +241,10 @@ def generate_improved_story(original_story, hashtags, image_path=None):
             import traceback
             traceback.print_exc()
         return None
+    finally:
+        # Don't leave one-off uploads in the account's file storage
+        if uploaded:
+            await delete_uploads([uploaded.id])
 
 
 def has_story_file(txt_path, timestamp):
@@ -171,37 +254,71 @@ def has_story_file(txt_path, timestamp):
     return os.path.exists(story_path)
 
 
-def find_story_files(directory):
+def list_file_names(directory):
+    """Return the set of file names in a directory, from a single scan"""
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+
+def image_paths(directory, names):
+    """Map timestamp -> PNG path for a directory's file names, so batch runs look images up without a stat"""
+    return {name[:-4]: os.path.join(directory, name) for name in names if name.endswith('.png')}
+
+
+def find_story_files(directory, names=None):
     """Find all .txt files (without _story) that are missing corresponding _story.txt files"""
     txt_files = []
     
     if not os.path.isdir(directory):
         return txt_files
     
+    # One directory read; story file existence is a set lookup, not a stat
+    if names is None:
+        names = list_file_names(directory)
+    
     # Find all .txt files that don't have _story in the name
-    for filename in os.listdir(directory):
+    skipped = 0
+    for filename in sorted(names):
         if filename.endswith('.txt') and '_story' not in filename:
-            txt_path = os.path.join(directory, filename)
             timestamp = extract_timestamp_from_filename(filename)
             
             if timestamp:
                 # Check if _story.txt file exists
-                if not has_story_file(txt_path, timestamp):
-                    txt_files.append(txt_path)
+                if f"{timestamp}_story.txt" not in names:
+                    txt_files.append(os.path.join(directory, filename))
                 else:
-                    print(f"⏭️  Skipping {filename} (_story.txt file already exists)")
+                    skipped += 1
     
-    return sorted(txt_files)
+    if skipped:
+        print(f"⏭️  Skipping {skipped:,} file(s) (_story.txt already present)")
+    
+    return txt_files
 
 
-def process_story_file(txt_path):
-    """Process a .txt file and create the corresponding _story.txt file"""
+def write_story_file(story_path, story):
+    """Write a _story.txt file; return True on success"""
+    try:
+        with open(story_path, 'w', encoding='utf-8') as f:
+            f.write(story)
+            f.write("\n")
+        print(f"✅ Created _story.txt file: {os.path.basename(story_path)}")
+        return True
+    except Exception as e:
+        print(f"❌ Error creating _story.txt file: {e}")
+        return False
+
+
+async def process_story_file(txt_path, pngs=None):
+    """Process a .txt file and create the corresponding _story.txt file
+
+    pngs is the directory's timestamp -> PNG path map, if already scanned.
+    """
     print(f"\n{'='*60}")
     print(f"📖 Processing file: {txt_path}")
     print(f"{'='*60}")
     
     # Extract timestamp from filename
-    filename = os.path.basename(txt_path)
+    story_dir, filename = os.path.split(txt_path)
     timestamp = extract_timestamp_from_filename(filename)
     
     if not timestamp:
@@ -211,8 +328,8 @@ def process_story_file(txt_path):
     
     print(f"📅 Extracted timestamp: {timestamp}")
     
-    # Read original story from .txt file
-    original_story = read_story_file(txt_path)
+    # Read original story from .txt file (file I/O runs off the event loop)
+    original_story = await asyncio.to_thread(read_story_file, txt_path)
     if not original_story:
         return False
     
@@ -226,56 +343,176 @@ def process_story_file(txt_path):
         print("🏷️  No hashtags found")
     
     # Find image file
-    image_path = find_image_file(txt_path, timestamp)
+    image_path = pngs.get(timestamp) if pngs is not None else find_image_file(txt_path, timestamp, story_dir)
     
     if image_path:
         print(f"🖼️  Found image: {image_path}")
     else:
         print(f"⚠️  Image file not found for timestamp: {timestamp}")
-        print(f"   Expected: {os.path.join(os.path.dirname(txt_path), f'{timestamp}.png')}")
+        print(f"   Expected: {os.path.join(story_dir, f'{timestamp}.png')}")
         print("   Continuing without image context...")
     
     # Generate improved story (includes image in request if available)
-    improved_story = generate_improved_story(original_story, hashtags, image_path)
+    improved_story = await generate_improved_story(original_story, hashtags, image_path)
     if not improved_story:
         return False
     
     # Create the _story.txt file
-    story_dir = os.path.dirname(txt_path)
-    story_path = os.path.join(story_dir, f"{timestamp}_story.txt")
-    
-    try:
-        with open(story_path, 'w', encoding='utf-8') as f:
-            f.write(improved_story)
-            f.write("\n")
-        print(f"✅ Created _story.txt file: {os.path.basename(story_path)}")
-    except Exception as e:
-        print(f"❌ Error creating _story.txt file: {e}")
+    story_name = f"{timestamp}_story.txt"
+    if not await asyncio.to_thread(write_story_file, os.path.join(story_dir, story_name), improved_story):
         return False
     
-    print(f"✅ Post edit complete for: {os.path.basename(txt_path)}")
-    print(f"   📝 Created: {os.path.basename(story_path)}")
-    print(f"   📄 Original unchanged: {os.path.basename(txt_path)}")
+    print(f"✅ Post edit complete for: {filename}")
+    print(f"   📝 Created: {story_name}")
+    print(f"   📄 Original unchanged: {filename}")
     return True
 
 
+async def process_all(txt_files, pngs=None):
+    """Process files concurrently, at most POSTEDIT_CONCURRENCY OpenAI calls at a time"""
+    sem = asyncio.Semaphore(POSTEDIT_CONCURRENCY)
+
+    async def process_one(i, txt_path):
+        async with sem:
+            print(f"\n[{i}/{len(txt_files)}]")
+            return await process_story_file(txt_path, pngs)
+
+    return await asyncio.gather(
+        *(process_one(i, txt_path) for i, txt_path in enumerate(txt_files, 1)),
+        return_exceptions=True
+    )
+
+
+def response_output_text(body):
+    """Join the output_text parts of a raw Responses API body"""
+    return "".join(
+        part.get("text", "")
+        for item in body.get("output", []) if item.get("type") == "message"
+        for part in item.get("content", []) if part.get("type") == "output_text"
+    )
+
+
+async def batch_all(txt_files, pngs=None):
+    """Generate all stories in one Batch API job (half price, done within 24h)
+
+    Returns one True/False per file, like process_all.
+    """
+    sem = asyncio.Semaphore(POSTEDIT_CONCURRENCY)
+
+    def story_path_for(txt_path):
+        story_dir, filename = os.path.split(txt_path)
+        return os.path.join(story_dir, f"{extract_timestamp_from_filename(filename)}_story.txt")
+
+    async def prepare(txt_path):
+        # Read the post and upload its image; the batch references it by file_id.
+        # A cached story comes back as a plain string and skips the batch.
+        story_dir, filename = os.path.split(txt_path)
+        timestamp = extract_timestamp_from_filename(filename)
+        original_story = await asyncio.to_thread(read_story_file, txt_path)
+        if not timestamp or not original_story:
+            return None
+        hashtags = extract_hashtags(original_story)
+        image_path = pngs.get(timestamp) if pngs is not None else find_image_file(txt_path, timestamp, story_dir)
+        cache_path = None
+        if LLM_CACHE:
+            cache_path = await asyncio.to_thread(story_cache_path, original_story, hashtags, image_path)
+            cached = await asyncio.to_thread(read_cached_story, cache_path)
+            if cached:
+                return cached
+        file_id = None
+        if image_path:
+            async with sem:
+                try:
+                    file_id = (await _upload_image(image_path)).id
+                except openai.OpenAIError as e:
+                    print(f"❌ Error uploading {image_path}: {e}")
+                    return None
+        return story_request(original_story, hashtags, file_id), file_id, cache_path
+
+    print(f"📤 Preparing {len(txt_files)} request(s)...")
+    prepared = await asyncio.gather(*(prepare(txt_path) for txt_path in txt_files), return_exceptions=True)
+    bodies = {}
+    cache_paths = {}
+    image_ids = []
+    done = {}
+    for txt_path, item in zip(txt_files, prepared):
+        if isinstance(item, Exception):
+            print(f"❌ Error preparing {txt_path}: {item}")
+        elif isinstance(item, str):
+            print(f"🗃️ Reused cached story for {os.path.basename(txt_path)}")
+            done[txt_path] = write_story_file(story_path_for(txt_path), item)
+        elif item:
+            bodies[txt_path], file_id, cache_paths[txt_path] = item
+            if file_id:
+                image_ids.append(file_id)
+    if not bodies:
+        await delete_uploads(image_ids)
+        return [done.get(txt_path, False) for txt_path in txt_files]
+
+    # custom_id is the file's index, unique even if timestamps repeat
+    lines = b"\n".join(
+        orjson.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/responses", "body": body})
+        for i, body in enumerate(bodies.values())
+    )
+    stories = {}
+    uploads = list(image_ids)
+    try:
+        batch_file = await client.files.create(file=("postedit.jsonl", lines), purpose="batch")
+        uploads.append(batch_file.id)
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/responses", completion_window="24h")
+        print(f"📦 Submitted batch {batch.id} ({len(bodies)} stories), checking every {BATCH_POLL_SECONDS}s")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            batch = await client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            print(f"⏳ Batch {batch.status}: {counts.completed if counts else 0}/{len(bodies)} done")
+
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            for line in output.content.splitlines():
+                row = orjson.loads(line)
+                response = row.get("response") or {}
+                if response.get("status_code") == 200:
+                    stories[int(row["custom_id"])] = clean_response_text(response_output_text(response["body"]))
+        if batch.status != "completed":
+            print(f"❌ Batch ended as {batch.status}")
+    except openai.OpenAIError as e:
+        print(f"❌ Batch error: {e}")
+    finally:
+        # Whatever happened (errors, Ctrl-C mid-poll), don't leave the images
+        # and the request file in the account's file storage
+        await delete_uploads(uploads)
+
+    # Write every story in one sweep
+    for i, txt_path in enumerate(bodies):
+        story = stories.get(i)
+        if story:
+            done[txt_path] = write_story_file(story_path_for(txt_path), story)
+            if cache_paths[txt_path]:
+                cache_story(cache_paths[txt_path], story)
+    return [done.get(txt_path, False) for txt_path in txt_files]
+
+
 def main():
     """Main function"""
     if len(sys.argv) < 2:
         print("Usage:")
         print("  python postedit.py <txt_file_path>")
         print("  python postedit.py --all <directory_path>")
+        print("  python postedit.py --batch <directory_path>")
         print("\nExamples:")
         print("  python postedit.py ../nextjs/db/2025-10-26-215555.txt")
         print("  python postedit.py --all ../nextjs/db")
+        print("  python postedit.py --batch ../nextjs/db   (Batch API: half price, results within 24h)")
         print("\nNote: Processes .txt files (without _story) and creates _story.txt files")
         sys.exit(1)
     
     # Check if processing all files in a directory
-    if sys.argv[1] == '--all' or sys.argv[1] == '-a':
+    if sys.argv[1] in ('--all', '-a', '--batch'):
         if len(sys.argv) < 3:
-            print("❌ Error: Directory path required with --all option")
-            print("Usage: python postedit.py --all <directory_path>")
+            print(f"❌ Error: Directory path required with {sys.argv[1]} option")
+            print(f"Usage: python postedit.py {sys.argv[1]} <directory_path>")
             sys.exit(1)
         
         directory = sys.argv[2]
@@ -298,7 +535,9 @@ def main():
         print(f"⏭️  Skipping files that already have _story.txt files\n")
         
         # Find all .txt files without corresponding _story.txt files
-        txt_files = find_story_files(directory)
+        names = list_file_names(directory)
+        txt_files = find_story_files(directory, names)
+        pngs = image_paths(directory, names)
         
         if not txt_files:
             print("✅ No .txt files found to process (all have _story.txt files or no .txt files found)")
@@ -306,17 +545,23 @@ def main():
         
         print(f"📋 Found {len(txt_files)} .txt file(s) to process\n")
         
-        # Process each file
+        # Process files concurrently, or as one Batch API job
         success_count = 0
         fail_count = 0
         
-        for i, txt_path in enumerate(txt_files, 1):
-            print(f"\n[{i}/{len(txt_files)}]")
-            if process_story_file(txt_path):
+        if sys.argv[1] == '--batch':
+            results = asyncio.run(batch_all(txt_files, pngs))
+        else:
+            results = asyncio.run(process_all(txt_files, pngs))
+        for txt_path, result in zip(txt_files, results):
+            if result is True:
                 success_count += 1
             else:
                 fail_count += 1
-                print(f"⚠️  Failed to process: {txt_path}")
+                if isinstance(result, Exception):
+                    print(f"⚠️  Failed to process: {txt_path} ({result})")
+                else:
+                    print(f"⚠️  Failed to process: {txt_path}")
         
         # Summary
         print(f"\n{'='*60}")
@@ -365,7 +610,7 @@ def main():
             print(f"   Skipping to avoid overwriting existing _story.txt")
             sys.exit(0)
         
-        success = process_story_file(txt_path)
+        success = asyncio.run(process_story_file(txt_path))
         
         if success:
             print(f"\n🎉 Post edit complete!")
@@ -3,12 +3,20 @@
 
 import requests
 import json
+import orjson
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from probe_http import SESSION, post_json, body_preview
 
 # Load environment variables
 load_dotenv()
 
+# Words on the SwarmUI home page that suggest a login is required
+AUTH_RE = re.compile(r'login|password|auth|signin|signup|username|user|credential|token', re.IGNORECASE)
+
 def test_endpoints():
     """Test SwarmUI API endpoints and connectivity"""
     
@@ -25,55 +33,103 @@ def test_endpoints():
         if url not in unique_urls:
             unique_urls.append(url)
     
-    for swarmui_url in unique_urls:
-        print(f"\n🔍 Testing connection to: {swarmui_url}")
-        if test_swarmui_endpoints(swarmui_url):
-            print(f"✅ All endpoints working on {swarmui_url}")
-            return True
-        print(f"❌ Some endpoints failed on {swarmui_url}")
+    # Only the cheap connectivity and session checks run on all URLs at
+    # once, so a dead URL costs at most its own timeout. The URLs usually
+    # point at the same server, so the heavier checks (including a
+    # generation) then run once, on the first URL that answered.
+    print(f"\n🔍 Testing connection to: {', '.join(unique_urls)}")
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(unique_urls))
+    futures = {executor.submit(connect_swarmui, url, stop): url for url in unique_urls}
+    swarmui_url = session_id = None
+    try:
+        for future in as_completed(futures):
+            session_id = future.result()
+            if session_id:
+                swarmui_url = futures[future]
+                break
+    finally:
+        # Probes still waiting on a dead URL go quiet instead of printing
+        # into the rest of the run
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
     
-    print("\n❌ All connection attempts failed!")
+    if not swarmui_url:
+        print("\n❌ All connection attempts failed!")
+        return False
+    
+    print(f"\n✅ Connected to {swarmui_url}, testing the remaining endpoints there")
+    if test_swarmui_endpoints(swarmui_url, session_id):
+        print(f"✅ All endpoints working on {swarmui_url}")
+        return True
+    print(f"❌ Some endpoints failed on {swarmui_url}")
     return False
 
-def test_swarmui_endpoints(swarmui_url):
-    """Test all SwarmUI endpoints for a specific URL"""
+def url_printer(swarmui_url, stop=None):
+    """Return a print function that prefixes lines with the URL being probed"""
+    def say(message):
+        if stop is None or not stop.is_set():
+            print(f"[{swarmui_url}] {message}")
+    return say
+
+def connect_swarmui(swarmui_url, stop):
+    """Check that SwarmUI answers on a URL and create a session; return the session id or None"""
+    say = url_printer(swarmui_url, stop)
     
     try:
         # Test basic connectivity
-        print("📡 Testing basic connectivity...")
-        response = requests.get(f"{swarmui_url}/", timeout=5)
-        print(f"✅ Basic connection: HTTP {response.status_code}")
+        say("📡 Testing basic connectivity...")
+        response = SESSION.get(f"{swarmui_url}/", timeout=5)
+        say(f"✅ Basic connection: HTTP {response.status_code}")
         
         if "SwarmUI" not in response.text:
-            print("❌ SwarmUI interface not detected")
-            return False
+            say("❌ SwarmUI interface not detected")
+            return None
         
-        print("✅ SwarmUI web interface detected")
+        say("✅ SwarmUI web interface detected")
         
         # Test session creation
-        print("\n🎫 Testing session creation...")
-        session_response = requests.post(f"{swarmui_url}/API/GetNewSession", json={}, timeout=10)
+        say("🎫 Testing session creation...")
+        session_response = post_json(f"{swarmui_url}/API/GetNewSession", {}, timeout=10)
         if session_response.status_code != 200:
-            print(f"❌ Session creation failed: {session_response.status_code}")
-            return False
+            say(f"❌ Session creation failed: {session_response.status_code}")
+            return None
         
-        session_data = session_response.json()
-        session_id = session_data.get("session_id")
-        print(f"✅ Session created: {session_id}")
+        session_id = orjson.loads(session_response.content).get("session_id")
+        say(f"✅ Session created: {session_id}")
+        return session_id
         
+    except requests.exceptions.ConnectionError as e:
+        say(f"❌ Connection error: {e}")
+        return None
+    except requests.exceptions.Timeout as e:
+        say(f"❌ Timeout error: {e}")
+        return None
+    except requests.exceptions.RequestException as e:
+        say(f"❌ Request error: {e}")
+        return None
+    except Exception as e:
+        say(f"❌ Unexpected error: {e}")
+        return None
+
+def test_swarmui_endpoints(swarmui_url, session_id):
+    """Test parameter listing, generation and method handling on a connected URL"""
+    say = url_printer(swarmui_url)
+    
+    try:
         # Test parameter listing
-        print("\n📋 Testing parameter listing...")
-        params_response = requests.post(f"{swarmui_url}/API/ListT2IParams", json={"session_id": session_id}, timeout=10)
+        say("📋 Testing parameter listing...")
+        params_response = post_json(f"{swarmui_url}/API/ListT2IParams", {"session_id": session_id}, timeout=10)
         if params_response.status_code != 200:
-            print(f"❌ Parameter listing failed: {params_response.status_code}")
+            say(f"❌ Parameter listing failed: {params_response.status_code}")
             return False
         
-        params_data = params_response.json()
+        params_data = orjson.loads(params_response.content)
         param_count = len(params_data.get("list", []))
-        print(f"✅ Parameters retrieved: {param_count} parameters")
+        say(f"✅ Parameters retrieved: {param_count} parameters")
         
         # Test image generation (quick test)
-        print("\n🎨 Testing image generation...")
+        say("🎨 Testing image generation...")
         test_payload = {
             "images": 1,
             "session_id": session_id,
@@ -88,46 +144,31 @@ def test_swarmui_endpoints(swarmui_url):
             "seed": -1
         }
         
-        gen_response = requests.post(f"{swarmui_url}/API/GenerateText2Image", json=test_payload, timeout=30)
+        gen_response = post_json(f"{swarmui_url}/API/GenerateText2Image", test_payload, timeout=30, stream=True)
         if gen_response.status_code == 200:
-            print("✅ Image generation test successful")
+            say("✅ Image generation test successful")
+            gen_response.close()
         else:
-            print(f"⚠️ Image generation test failed: {gen_response.status_code}")
-            print(f"   Response: {gen_response.text[:100]}...")
-        
-        # Test other endpoints
-        print("\n🔍 Testing other endpoints...")
-        endpoints_to_test = [
-            ("GET", "/API/GetNewSession"),
-            ("POST", "/API/GetNewSession"),
-        ]
+            say(f"⚠️ Image generation test failed: {gen_response.status_code}")
+            say(f"   Response: {body_preview(gen_response, 100)}...")
         
-        for method, endpoint in endpoints_to_test:
-            try:
-                if method == "GET":
-                    response = requests.get(f"{swarmui_url}{endpoint}", timeout=5)
-                else:
-                    response = requests.post(f"{swarmui_url}{endpoint}", json={}, timeout=5)
-                
-                content_type = response.headers.get('Content-Type', '')
-                print(f"📊 {method} {endpoint}: {response.status_code}, {content_type}")
-                
-            except requests.exceptions.RequestException as e:
-                print(f"❌ {method} {endpoint}: {e}")
+        # POST /API/GetNewSession was already covered above; only check
+        # how the server answers a GET on the same endpoint
+        say("🔍 Testing GET method semantics...")
+        try:
+            response = SESSION.get(f"{swarmui_url}/API/GetNewSession", timeout=5)
+            content_type = response.headers.get('Content-Type', '')
+            say(f"📊 GET /API/GetNewSession: {response.status_code}, {content_type}")
+        except requests.exceptions.RequestException as e:
+            say(f"❌ GET /API/GetNewSession: {e}")
         
         return True
         
-    except requests.exceptions.ConnectionError as e:
-        print(f"❌ Connection error: {e}")
-        return False
-    except requests.exceptions.Timeout as e:
-        print(f"❌ Timeout error: {e}")
-        return False
     except requests.exceptions.RequestException as e:
-        print(f"❌ Request error: {e}")
+        say(f"❌ Request error: {e}")
         return False
     except Exception as e:
-        print(f"❌ Unexpected error: {e}")
+        say(f"❌ Unexpected error: {e}")
         return False
 
 def check_authentication():
@@ -136,16 +177,9 @@ def check_authentication():
     swarmui_url = os.getenv("SWARMUI_URL", "http://127.0.0.1:7801")
     
     try:
-        response = requests.get(f"{swarmui_url}/", timeout=10)
-        auth_indicators = [
-            "login", "password", "auth", "signin", "signup", 
-            "username", "user", "credential", "token"
-        ]
-        
-        found_auth = []
-        for indicator in auth_indicators:
-            if indicator.lower() in response.text.lower():
-                found_auth.append(indicator)
+        response = SESSION.get(f"{swarmui_url}/", timeout=10)
+        # One case-insensitive pass over the page for all indicators
+        found_auth = sorted({match.lower() for match in AUTH_RE.findall(response.text)})
         
         if found_auth:
             print(f"⚠️ Found potential auth indicators: {found_auth}")
@@ -1,10 +1,11 @@
 # SwarmUI Parameter Explorer
 # Gets key parameters for image generation
 
-import requests
 import json
+import orjson
 import os
 from dotenv import load_dotenv
+from probe_http import post_json
 
 # Load environment variables
 load_dotenv()
@@ -16,22 +17,22 @@ def get_swarmui_params():
     
     try:
         # Get session
-        session_response = requests.post(f"{swarmui_url}/API/GetNewSession", json={}, timeout=10)
+        session_response = post_json(f"{swarmui_url}/API/GetNewSession", {}, timeout=10)
         if session_response.status_code != 200:
             print(f"❌ Failed to get session: {session_response.status_code}")
             return
             
-        session_data = session_response.json()
+        session_data = orjson.loads(session_response.content)
         session_id = session_data.get("session_id")
         print(f"✅ Got session ID: {session_id}")
         
         # Get parameters
-        params_response = requests.post(f"{swarmui_url}/API/ListT2IParams", json={"session_id": session_id}, timeout=10)
+        params_response = post_json(f"{swarmui_url}/API/ListT2IParams", {"session_id": session_id}, timeout=10)
         if params_response.status_code != 200:
             print(f"❌ Failed to get parameters: {params_response.status_code}")
             return
             
-        data = params_response.json()
+        data = orjson.loads(params_response.content)
         params_list = data.get("list", [])
         models = data.get("models", {})
         
@@ -47,12 +48,21 @@ def get_swarmui_params():
         
         print(f"\n🔍 Looking for key parameters: {important_params}")
         
+        # One pass over the list fills the key parameters and both
+        # sampler/scheduler groups, lowercasing each id and name once
+        important_lower = [(important, important.lower()) for important in important_params]
+        sampler_params, scheduler_params = [], []
         for param in params_list:
-            param_id = param.get("id", "").lower()
-            param_name = param.get("name", "")
+            param_id = (param.get("id") or "").lower()
+            param_name = (param.get("name") or "").lower()
             
-            for important in important_params:
-                if important.lower() in param_id or important.lower() in param_name.lower():
+            if "sampler" in param_id or "sampler" in param_name:
+                sampler_params.append(param)
+            if "scheduler" in param_id or "scheduler" in param_name:
+                scheduler_params.append(param)
+            
+            for important, important_low in important_lower:
+                if important_low in param_id or important_low in param_name:
                     key_params[important] = {
                         "id": param.get("id"),
                         "name": param.get("name"),
@@ -69,7 +79,6 @@ def get_swarmui_params():
         
         # Show ALL sampler and scheduler options
         print(f"\n🎨 ALL Sampler parameters found:")
-        sampler_params = [p for p in params_list if "sampler" in p.get("id", "").lower() or "sampler" in p.get("name", "").lower()]
         for param in sampler_params:
             print(f"   📊 {param.get('name')} (id: {param.get('id')})")
             if param.get("values"):
@@ -78,7 +87,6 @@ def get_swarmui_params():
                 print(f"      Default: {param.get('default', 'Unknown')}")
         
         print(f"\n⏰ ALL Scheduler parameters found:")
-        scheduler_params = [p for p in params_list if "scheduler" in p.get("id", "").lower() or "scheduler" in p.get("name", "").lower()]
         for param in scheduler_params:
             print(f"   📊 {param.get('name')} (id: {param.get('id')})")
             if param.get("values"):
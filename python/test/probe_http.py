@@ -0,0 +1,23 @@
+# Shared HTTP helpers for the SwarmUI probe scripts
+
+import requests
+from requests.adapters import HTTPAdapter
+import orjson
+
+# One keep-alive session, so every probe reuses the same connection
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive"})
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+def post_json(url, payload, **kwargs):
+    """POST an orjson-encoded body on the shared session"""
+    return SESSION.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, **kwargs)
+
+def body_preview(response, limit):
+    """Read only the first bytes of a streamed response body for printing"""
+    try:
+        return response.raw.read(limit, decode_content=True).decode('utf-8', 'replace')
+    finally:
+        response.close()
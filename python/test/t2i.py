@@ -1,16 +1,20 @@
 # Debug SwarmUI Request
 # Test the exact payload from gen.py to see what's causing the 500 error
 
-import requests
 import json
+import orjson
 import os
 from dotenv import load_dotenv
+from probe_http import post_json, body_preview
 
 # Load environment variables
 load_dotenv()
 
 SWARMUI_URL = os.getenv("SWARMUI_URL", "http://127.0.0.1:7801")
 
+# Refuse to parse generation responses bigger than this as JSON
+MAX_JSON_BYTES = 10_000_000
+
 def debug_swarmui_request():
     """Debug the exact request that's failing in gen.py"""
     
@@ -20,12 +24,12 @@ def debug_swarmui_request():
     # Get a session first
     print("🎫 Getting session...")
     try:
-        session_response = requests.post(f"{SWARMUI_URL}/API/GetNewSession", json={}, timeout=10)
+        session_response = post_json(f"{SWARMUI_URL}/API/GetNewSession", {}, timeout=10)
         if session_response.status_code != 200:
             print(f"❌ Session creation failed: {session_response.status_code}")
             return False
         
-        session_data = session_response.json()
+        session_data = orjson.loads(session_response.content)
         session_id = session_data.get("session_id")
         print(f"✅ Session created: {session_id}")
         
@@ -58,20 +62,25 @@ def debug_swarmui_request():
     # Try the request
     print(f"\n🎨 Testing image generation...")
     try:
-        response = requests.post(f"{SWARMUI_URL}/API/GenerateText2Image", json=payload, timeout=120)
+        response = post_json(f"{SWARMUI_URL}/API/GenerateText2Image", payload, timeout=120, stream=True)
         print(f"📊 Response status: {response.status_code}")
         print(f"📊 Response headers: {dict(response.headers)}")
         
         if response.status_code == 200:
             print("✅ Image generation successful!")
-            result = response.json()
+            content_length = int(response.headers.get('Content-Length', '0'))
+            if content_length > MAX_JSON_BYTES:
+                print(f"⚠️ Response too large to parse: {content_length} bytes")
+                response.close()
+                return True
+            result = orjson.loads(response.content)
             print(f"📊 Response keys: {list(result.keys())}")
             if "images" in result:
                 print(f"📊 Generated {len(result['images'])} image(s)")
             return True
         else:
             print(f"❌ Image generation failed: {response.status_code}")
-            print(f"📊 Response text: {response.text[:500]}...")
+            print(f"📊 Response text: {body_preview(response, 500)}...")
             return False
             
     except Exception as e:
@@ -86,8 +95,8 @@ def test_simplified_payload():
     
     # Get session
     try:
-        session_response = requests.post(f"{SWARMUI_URL}/API/GetNewSession", json={}, timeout=10)
-        session_data = session_response.json()
+        session_response = post_json(f"{SWARMUI_URL}/API/GetNewSession", {}, timeout=10)
+        session_data = orjson.loads(session_response.content)
         session_id = session_data.get("session_id")
         print(f"✅ Session: {session_id}")
     except Exception as e:
@@ -114,15 +123,16 @@ def test_simplified_payload():
     print(f"\n📊 Simple payload: {json.dumps(simple_payload, indent=2)}")
     
     try:
-        response = requests.post(f"{SWARMUI_URL}/API/GenerateText2Image", json=simple_payload, timeout=120)
+        response = post_json(f"{SWARMUI_URL}/API/GenerateText2Image", simple_payload, timeout=120, stream=True)
         print(f"📊 Response status: {response.status_code}")
         
         if response.status_code == 200:
             print("✅ Simple payload works!")
+            response.close()
             return True
         else:
             print(f"❌ Simple payload failed: {response.status_code}")
-            print(f"📊 Response: {response.text[:200]}...")
+            print(f"📊 Response: {body_preview(response, 200)}...")
             return False
             
     except Exception as e: